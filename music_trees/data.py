@@ -3,22 +3,24 @@
 
 import os
 import random
+import hashlib
 import logging
 from pathlib import Path
 from collections import OrderedDict
-import pickle
 
 import pytorch_lightning as pl
 import torch
 import numpy as np
 from nussl import AudioSignal
 import music_trees as mt
-import tqdm
-from tqdm.contrib.concurrent import process_map
+from tqdm.contrib.concurrent import process_map, thread_map
 
 import unicodedata
 import re
 
+_SLUG_RE_STRIP = re.compile(r'[^\w\s-]')
+_SLUG_RE_DASH = re.compile(r'[-\s]+')
+
 
 def records2lists(records):
     """ converts a list of dicts (records) to 
@@ -61,14 +63,20 @@ def slugify(value, allow_unicode=False):
     else:
         value = unicodedata.normalize('NFKD', value).encode(
             'ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value.lower())
-    return re.sub(r'[-\s]+', '-', value).strip('-_')
+    value = _SLUG_RE_STRIP.sub('', value.lower())
+    return _SLUG_RE_DASH.sub('-', value).strip('-_')
+
+
+def _tmp_path(path: Path):
+    """ a temp path next to path, unique to this process,
+    to write to before moving a file into place """
+    return path.with_name(f'{path.stem}.{os.getpid()}.tmp{path.suffix}')
 
 
 class MetaDataset(torch.utils.data.Dataset):
 
     def __init__(self, name: str, partition: str, n_episodes: int, n_class: int, n_shot: int,
-                 n_query: int, audio_tfm=None, deterministic=False):
+                 n_query: int, audio_tfm=None, deterministic=False, mem_cache_bytes: int = 0):
         """pytorch dataset for meta learning. 
 
         Args:
@@ -82,12 +90,17 @@ class MetaDataset(torch.utils.data.Dataset):
             deterministic (bool): if True, the same episode will always be returned for a particular index. 
                 Else, a new randomly generated episode is always created. Setting to true requires writing and reading 
                 from disk, so it may be slower.
+            mem_cache_bytes (int): memory budget (in bytes) for the in-memory LRU cache of 
+                transformed entries. Disabled (0) by default. Each DataLoader worker keeps its own 
+                private copy of the cached features, so the total cost is roughly num_workers * mem_cache_bytes.
         """
         super().__init__()
         # load the classlist for this partition
+        self.name = name
+        self.partition = partition
         self.root = mt.DATA_DIR / name
         self.deterministic = deterministic
-        self.files = self._load_files(name, partition)
+        self._files = self._load_files(name, partition)
         self.classes = sorted(list(self.files.keys()))
 
         self.n_episodes = n_episodes
@@ -98,20 +111,73 @@ class MetaDataset(torch.utils.data.Dataset):
 
         self.audio_tfm = audio_tfm
 
+        # in-memory LRU cache of transformed entries, keyed by uuid
+        self.mem_cache_bytes = mem_cache_bytes
+        self._reset_mem_cache()
+
         cache_name = repr(self.audio_tfm)
         self.cache_root = mt.CACHE_DIR / name / cache_name
         self.cache_root.mkdir(exist_ok=True, parents=True)
         # self.cache_dataset()
 
+        # the record lists are written to a single file here,
+        # so DataLoader workers can load them in one go
+        # instead of globbing and parsing every metadata file
+        fingerprint = self._files_fingerprint()
+        self.files_cache_path = self.cache_root.parent / \
+            f'cached_files-{partition}-{fingerprint}.pkl'
+        if not self.files_cache_path.exists():
+            tmp_path = _tmp_path(self.files_cache_path)
+            mt.utils.data.save_pickle(self._files, tmp_path)
+            os.replace(tmp_path, self.files_cache_path)
+
+        # after caching, all features for this partition can be
+        # consolidated into a single array here (see cache_dataset).
+        # rows are only valid for the exact same record lists,
+        # so the store is keyed on a fingerprint of them
+        self.feature_store_root = self.cache_root / \
+            f'features-{partition}-{fingerprint}'
+        self._feature_store = None
+
         # generally, we want to create new episodes
         # on the fly
         # however, for validation and evaluation,
         # we want the episodes to remain deterministic
-        # so we'll cache the episode metadata here
-
-        self.epi_cache_root = self.cache_root.parent /  \
-            f'{cache_name}-deterministic-episodes-{partition}-k{n_shot}-c{n_class}-q{n_query}'
-        self.epi_cache_root.mkdir(exist_ok=True)
+        # so we'll cache the (class_idx, example_idx) pairs
+        # for all episodes in a single array here
+
+        # example indices are only valid for the exact same record lists,
+        # so the cache is keyed on a fingerprint of them
+        self.epi_cache_path = self.cache_root.parent /  \
+            f'{cache_name}-deterministic-episodes-{partition}-k{n_shot}-c{n_class}-q{n_query}-n{n_episodes}-{fingerprint}.npy'
+        self._epi_mmap = None
+        if self.deterministic and not self.epi_cache_path.exists():
+            self._build_episode_cache()
+
+    # attributes that get sent to DataLoader workers.
+    # everything else is rebuilt lazily on the worker side
+    _PICKLED_ATTRS = ('name', 'partition', 'root', 'classes', 'n_episodes',
+                      'n_class', 'n_shot', 'n_query', 'audio_tfm', 'deterministic', 'mem_cache_bytes',
+                      'cache_root', 'files_cache_path', 'feature_store_root', 'epi_cache_path')
+
+    def __getstate__(self):
+        return {k: self.__dict__[k] for k in self._PICKLED_ATTRS}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._files = None
+        self._feature_store = None
+        self._epi_mmap = None
+        self._reset_mem_cache()
+
+    @property
+    def files(self):
+        """ OrderedDict with format {classname: List[entry]} """
+        if self._files is None:
+            # we're in a DataLoader worker, so load the
+            # record lists written by the main process
+            self._files = mt.utils.data.load_pickle(self.files_cache_path)
+        return self._files
 
     def __len__(self):
         return self.n_episodes
@@ -120,14 +186,15 @@ class MetaDataset(torch.utils.data.Dataset):
         classlist = mt.utils.data.load_entry(mt.ASSETS_DIR / 'partitions' / f'{name}.json',
                                              format='json')[partition]
 
-        cached_files = self.root / f'cached_files-{partition}.yaml'
-
         logging.info('loading files')
         files = {classname: mt.utils.data.glob_all_metadata_entries(
             self.root / classname, pattern='**/*.json') for classname in classlist}
 
-        # sort by key
+        # sort by key, and sort records by uuid so that
+        # example indices are stable across runs
         files = OrderedDict(sorted(files.items(), key=lambda x: x[0]))
+        for records in files.values():
+            records.sort(key=lambda e: e['uuid'])
         logging.info('done')
 
         # if we're doing deterministic (validation or testing),
@@ -150,33 +217,188 @@ class MetaDataset(torch.utils.data.Dataset):
         """ cache all entries in the dataset """
         logging.info(f'caching dataset...')
 
-        # go through all classnames
-        for cl, records in tqdm.tqdm(self.files.items(),  disable=mt.TQDM_DISABLE):
-            # process_map(self.cache_if_needed, records, disable=mt.TQDM_DISABLE)
-            for i, entry in enumerate(records):
-                # all files belonging to a class
-                self.cache_if_needed(entry)
+        # flatten all classes into a single list of entries,
+        # so that one pool of workers handles the whole dataset
+        all_entries = [e for records in self.files.values() for e in records]
+
+        # checking the cache is I/O bound, so threads are enough for it.
+        # only the misses need to go through the (cpu bound) transforms
+        is_cached = thread_map(lambda e: self._cache_path(e).exists(), all_entries,
+                               disable=mt.TQDM_DISABLE)
+        misses = [e for e, hit in zip(all_entries, is_cached) if not hit]
+
+        if len(misses) > 0:
+            logging.info(f'{len(misses)} of {len(all_entries)} entries not cached')
+            num_workers = os.cpu_count()
+            process_map(self._ensure_cached, misses, max_workers=num_workers,
+                        chunksize=max(1, len(misses) // (4 * num_workers)),
+                        disable=mt.TQDM_DISABLE)
         logging.info('dataset cached!')
 
+        self.consolidate_cache(all_entries)
+
+    def consolidate_cache(self, entries: list):
+        """ gather the cached features for all entries into a single
+        (N, C, F, T) array (features.npy), with a uuid to row index (uuid2row.json).
+        episodes can then be loaded with a single fancy-index 
+        into the memory-mapped array.
+        """
+        uuid2row_path = self.feature_store_root / 'uuid2row.json'
+        if uuid2row_path.exists():
+            return
+
+        example = self._load_cached(entries[0])['audio']
+        if not isinstance(example, np.ndarray):
+            logging.info('cached entries are not arrays, skipping consolidation')
+            return
+
+        logging.info(f'consolidating features into {self.feature_store_root}')
+        self.feature_store_root.mkdir(exist_ok=True, parents=True)
+        tmp_path = _tmp_path(self.feature_store_root / 'features.npy')
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=example.dtype,
+                                             shape=(len(entries),) + example.shape)
+
+        def copy_row(row: int):
+            audio = self._load_cached(entries[row])['audio']
+            if audio.shape != example.shape:
+                return False
+            features[row] = audio
+            return True
+
+        # reading the cached entries is I/O bound, so use threads
+        copied = thread_map(copy_row, range(len(entries)),
+                            disable=mt.TQDM_DISABLE)
+        if not all(copied):
+            logging.warning('feature shapes differ, skipping consolidation')
+            del features
+            os.remove(tmp_path)
+            return
+        uuid2row = {entry['uuid']: row for row, entry in enumerate(entries)}
+
+        features.flush()
+        del features
+        os.replace(tmp_path, self.feature_store_root / 'features.npy')
+        # the index is written last, marking the store as complete
+        mt.utils.data.save_entry(uuid2row, uuid2row_path, format='json')
+        logging.info('features consolidated!')
+
+    def _load_feature_store(self):
+        """ returns the (memory-mapped) consolidated features and 
+        their uuid2row index, or None if the cache hasn't been consolidated"""
+        if self._feature_store is None:
+            uuid2row_path = self.feature_store_root / 'uuid2row.json'
+            if not uuid2row_path.exists():
+                return None
+            features = np.load(self.feature_store_root / 'features.npy',
+                               mmap_mode='r')
+            uuid2row = mt.utils.data.load_entry(uuid2row_path, format='json')
+            self._feature_store = (features, uuid2row)
+        return self._feature_store
+
+    def _cache_path(self, entry: dict):
+        """ path to an entry in the cache """
+        return self.cache_root / entry['uuid']
+
+    def _ensure_cached(self, entry: dict):
+        """ make sure an entry is written to the cache, 
+        without reading it back if it's already there """
+        if not self._cache_path(entry).exists():
+            self._write_cached(entry)
+
+    def _write_cached(self, entry: dict):
+        """ transform an entry and save it to the cache.
+        feature arrays are saved to their own .npy file, so they can be
+        memory-mapped on load. only the metadata is pickled.
+        floating point features are stored as float16, and cast
+        back to float32 when an episode is processed.
+        """
+        cached_entry = self.transform_entry(entry)
+        entry_path = self._cache_path(entry)
+
+        audio = cached_entry['audio']
+        if isinstance(audio, np.ndarray) and np.issubdtype(audio.dtype, np.floating):
+            audio = audio.astype(np.float16)
+            cached_entry['audio'] = audio
+
+        metadata = dict(cached_entry)
+        if isinstance(audio, np.ndarray):
+            npy_path = entry_path.parent / f'{entry_path.name}.npy'
+            # never overwrite in place: another worker may have
+            # this file memory-mapped. the .npy goes first, since
+            # the pickle's existence marks the entry as cached
+            tmp_path = _tmp_path(npy_path)
+            np.save(tmp_path, audio)
+            os.replace(tmp_path, npy_path)
+            del metadata['audio']
+            metadata['npy_path'] = npy_path.name
+            metadata['shape'] = audio.shape
+            metadata['dtype'] = audio.dtype.str
+
+        tmp_path = _tmp_path(entry_path)
+        mt.utils.data.save_pickle(metadata, tmp_path)
+        os.replace(tmp_path, entry_path)
+        return cached_entry
+
+    def _load_cached(self, entry: dict):
+        """ read a transformed entry from the cache """
+        cached_entry = mt.utils.data.load_pickle(self._cache_path(entry))
+        if 'npy_path' in cached_entry:
+            cached_entry['audio'] = np.load(self.cache_root / cached_entry['npy_path'],
+                                            mmap_mode='r')
+        return cached_entry
+
+    def _reset_mem_cache(self):
+        self._mem_cache = OrderedDict()
+        self._mem_cache_size = 0
+
+    def _mem_cache_get(self, uuid: str):
+        """ retrieve a (shallow copy of a) transformed entry from the 
+        in-memory cache, or None if it isn't there """
+        if uuid not in self._mem_cache:
+            return None
+        self._mem_cache.move_to_end(uuid)
+        return dict(self._mem_cache[uuid])
+
+    def _mem_cache_set(self, uuid: str, entry: dict):
+        """ add a transformed entry to the in-memory cache, 
+        evicting the least recently used entries if over budget """
+        audio = entry['audio']
+        if not isinstance(audio, np.ndarray) or audio.nbytes > self.mem_cache_bytes:
+            return
+
+        # copy memory-mapped arrays into RAM
+        entry = dict(entry)
+        entry['audio'] = np.array(audio)
+        self._mem_cache[uuid] = entry
+        self._mem_cache_size += audio.nbytes
+
+        while self._mem_cache_size > self.mem_cache_bytes:
+            _, evicted = self._mem_cache.popitem(last=False)
+            self._mem_cache_size -= evicted['audio'].nbytes
+
     def cache_if_needed(self, entry: dict):
         """ Look for an entry in the cache. 
+        If the entry is in memory, return it.
         If the entry exists, read it from disk. 
         If the entry does not exist, transform it 
         and save it to disk """
-        entry_path = self.cache_root / entry['uuid']
-        if entry_path.exists():
-            with open(entry_path, 'rb') as f:
-                cached_entry = pickle.load(f)
-
-        if not entry_path.exists():
-            cached_entry = self.transform_entry(entry)
-            with open(entry_path, 'wb') as f:
-                pickle.dump(cached_entry, f)
-
-        cached_entry['audio_path'] = str(Path(
-            mt.utils.data.get_path(cached_entry)).with_suffix('.wav').absolute())
+        cached_entry = self._mem_cache_get(entry['uuid'])
+        if cached_entry is not None:
+            return cached_entry
+
+        if self._cache_path(entry).exists():
+            cached_entry = self._load_cached(entry)
+        else:
+            cached_entry = self._write_cached(entry)
+
+        cached_entry['audio_path'] = self._audio_path(cached_entry)
+        self._mem_cache_set(entry['uuid'], cached_entry)
         return cached_entry
 
+    @staticmethod
+    def _audio_path(entry: dict):
+        return str(Path(mt.utils.data.get_path(entry)).with_suffix('.wav').absolute())
+
     def transform_entry(self, entry: dict):
         """ apply the audio transforms to a given entry """
         # load audio
@@ -190,23 +412,31 @@ class MetaDataset(torch.utils.data.Dataset):
             entry = self.audio_tfm(entry)
         return entry
 
-    def _get_example_for_class(self, name: str):
-        """ sample an entry from the dataset, 
-        that matches the given class name
-        """
-        # grab a random file
-        entry = dict(random.choice(self.files[name]))
-        return entry
-
     def _process_episode(self, episode):
         """
         apply transforms to all entries in an episode
         and concatenate audio arrays together
         """
+        # if the cache has been consolidated, grab all
+        # the features for the episode in one go
+        feature_store = self._load_feature_store()
+        if feature_store is not None:
+            features, uuid2row = feature_store
+            rows = [uuid2row.get(e['uuid']) for e in episode['records']]
+            if None not in rows:
+                episode['x'] = features[rows].astype(np.float32)
+                for e in episode['records']:
+                    e['audio_path'] = self._audio_path(e)
+                return episode
+
         episode['records'] = [self.cache_if_needed(
             itm) for itm in episode['records']]
 
-        episode['x'] = np.stack([e['audio'] for e in episode['records']])
+        # stack straight into a float32 buffer, so that the cast
+        # from float16 doesn't need a second intermediate array
+        arrays = [e['audio'] for e in episode['records']]
+        x = np.empty((len(arrays),) + arrays[0].shape, dtype=np.float32)
+        episode['x'] = np.stack(arrays, out=x)
 
         # remove audio from records as we don't need it
         for e in episode['records']:
@@ -214,32 +444,61 @@ class MetaDataset(torch.utils.data.Dataset):
 
         return episode
 
-    def _episode_cache_get(self, index):
-        """ retrieve from episode cache """
-        return mt.utils.data.load_entry(self.epi_cache_root / f'{index}.json', format='json')
-
-    def _episode_cache_set(self, index, item):
-        """ write to episode cache """
-        mt.utils.data.save_entry(
-            item, self.epi_cache_root / str(index), format='json')
-
-    def _check_episode_cached(self, index):
-        """ check if index exists in episode cache """
-        return Path(self.epi_cache_root / str(index)).with_suffix('.json').exists()
-
-    def generate_episode(self):
-        """ generates an unprocessed episode"""
-        subset = random.sample(self.classes, k=self.n_class)
-        subset.sort()
+    def _files_fingerprint(self):
+        """ short hash of the classes and (sorted) record uuids """
+        md5 = hashlib.md5()
+        for name, records in self.files.items():
+            md5.update(name.encode())
+            for entry in records:
+                md5.update(entry['uuid'].encode())
+        return md5.hexdigest()[:8]
+
+    def _build_episode_cache(self):
+        """ sample all deterministic episodes and save them to disk
+        as a single (n_episodes, n_class * (n_shot + n_query), 2) array
+        """
+        logging.info(f'building episode cache at {self.epi_cache_path}')
+        rng = np.random.default_rng(random.getrandbits(64))
+        episodes = np.stack([self._sample_episode_indices(rng)
+                             for _ in range(self.n_episodes)])
 
-        records = []
+        # write to a temp file first, so a partially written
+        # cache is never picked up
+        tmp_path = _tmp_path(self.epi_cache_path)
+        np.save(tmp_path, episodes)
+        os.replace(tmp_path, self.epi_cache_path)
 
-        metatypes = {'support': self.n_shot, 'query': self.n_query}
-        for metatype, num_examples in metatypes.items():
-            for label_idx, name in enumerate(subset):
-                for meta_idx in range(num_examples):
-                    item = self._get_example_for_class(name)
-                    records.append(item)
+    def _episode_cache_get(self, index):
+        """ retrieve the (class_idx, example_idx) pairs for an episode """
+        if self._epi_mmap is None:
+            self._epi_mmap = np.load(self.epi_cache_path, mmap_mode='r')
+        return self._epi_mmap[index]
+
+    def _sample_episode_indices(self, rng: np.random.Generator):
+        """ samples an episode as an array of (class_idx, example_idx) pairs,
+        with shape (n_class * (n_shot + n_query), 2). 
+        all support examples come first, followed by all query examples, 
+        both sorted by class.
+        """
+        class_idxs = np.sort(rng.choice(len(self.classes), size=self.n_class,
+                                        replace=False))
+        num_examples = np.array([len(self.files[self.classes[c]])
+                                 for c in class_idxs])
+
+        # shape (n_class, n_shot + n_query)
+        example_idxs = rng.integers(num_examples[:, None],
+                                    size=(self.n_class, self.n_shot + self.n_query))
+        class_idxs = np.broadcast_to(class_idxs[:, None], example_idxs.shape)
+
+        pairs = np.stack([class_idxs, example_idxs], axis=-1)
+        pairs = np.concatenate([pairs[:, :self.n_shot].reshape(-1, 2),
+                                pairs[:, self.n_shot:].reshape(-1, 2)])
+        return pairs.astype(np.int32)
+
+    def _build_episode(self, pairs: np.ndarray):
+        """ builds an unprocessed episode from (class_idx, example_idx) pairs """
+        subset = [self.classes[c] for c in np.unique(pairs[:, 0])]
+        records = [dict(self.files[self.classes[c]][e]) for c, e in pairs]
 
         episode = {
             'n_class': len(subset),
@@ -250,6 +509,12 @@ class MetaDataset(torch.utils.data.Dataset):
         }
         return episode
 
+    def generate_episode(self):
+        """ generates an unprocessed episode"""
+        # seed from the random module, which torch reseeds in every worker
+        rng = np.random.default_rng(random.getrandbits(64))
+        return self._build_episode(self._sample_episode_indices(rng))
+
     def __getitem__(self, index: int):
         """returns a dict with format:
 
@@ -261,14 +526,11 @@ class MetaDataset(torch.utils.data.Dataset):
             'records' (List[dict]): list of dataset entries
         }
         """
-        if self.deterministic and self._check_episode_cached(index):
-            episode = self._episode_cache_get(index)
+        if self.deterministic:
+            episode = self._build_episode(self._episode_cache_get(index))
         else:
             episode = self.generate_episode()
-            episode['episode_index'] = index  # for debugging
-
-            if self.deterministic:
-                self._episode_cache_set(index, dict(episode))
+        episode['episode_index'] = index  # for debugging
 
         episode = self._process_episode(episode)
 
@@ -359,19 +621,37 @@ def episode_collate(batch):
 
     episode = batch[0]
 
+    # only pin from the main process. pinning needs a CUDA context,
+    # which forked workers can't create. (the DataLoader pins their output
+    # for us in the main process anyway)
+    pin_memory = torch.cuda.is_available() and \
+        torch.utils.data.get_worker_info() is None
+
     for key, val in episode.items():
         if isinstance(val, np.ndarray):
-            episode[key] = torch.tensor(val)
+            src = torch.from_numpy(val)
+            out = torch.empty(src.shape, dtype=src.dtype,
+                              pin_memory=pin_memory)
+            episode[key] = out.copy_(src)
 
     return episode
 
 
 def loader(dataset, partition, batch_size=64, num_workers=None):
     """Retrieve a data loader"""
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+
+    # keep workers alive across epochs, and prefetch deeper.
+    # (these can only be set when using worker processes)
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=4)
+
     return torch.utils.data.DataLoader(
         dataset=dataset,
         batch_size=batch_size,
         shuffle='train' in partition,
-        num_workers=os.cpu_count() if num_workers is None else num_workers,
+        num_workers=num_workers,
         pin_memory=True,
-        collate_fn=episode_collate)
+        collate_fn=episode_collate,
+        **worker_kwargs)
@@ -14,7 +14,6 @@ import torch
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from sklearn.metrics import f1_score, accuracy_score, confusion_matrix
 from embviz.logger import EmbeddingSpaceLogger
 
 DATASET = 'mdb-aug'
@@ -68,9 +67,8 @@ def evaluate(exp_dir):
 
         epi_classes = []
         outputs = []
-        for index, episode in tqdm(enumerate(dm.test_dataloader())):
+        for index, episode in tqdm(enumerate(prefetch2cuda(dm.test_dataloader()))):
             # episode should classlist, etc.
-            episode = batch2cuda(episode)
             # track the class list for each episode
             epi_classes.append(episode['classlist'])
 
@@ -109,15 +107,12 @@ def log_episode_space(logger: EmbeddingSpaceLogger, episode: dict, output: dict,
     n_support = output['n_shot'] * output['n_class']
     n_query = output['n_query'] * output['n_class']
 
-    # class index to class name
-    def gc(i): return output['classlist'][i]
-
     embeddings = [e for e in task['support_embedding']] + \
         [e for e in task['query_embedding']]
 
     support_labels = [r['label'] for r in output['records']][:n_support]
-    preds = support_labels + [gc(i) for i in task['pred']]
-    labels = support_labels + [gc(i) for i in task['target']]
+    preds = support_labels + idx2label(task['pred'].numpy(), output['classlist'])
+    labels = support_labels + idx2label(task['target'].numpy(), output['classlist'])
 
     metatypes = ['support'] * n_support
     for p, tr in zip(preds[n_support:], labels[n_support:]):
@@ -156,14 +151,104 @@ def load_model_from_ckpt(ckpt_path):
 def batch2cuda(batch):
     for k, v in batch.items():
         if isinstance(v, torch.Tensor):
-            batch[k] = v.to(DEVICE)
+            batch[k] = v.to(DEVICE, non_blocking=True)
         elif isinstance(v, dict):
             batch[k] = batch2cuda(v)
     return batch
 
 
-def idx2label(labels: torch.Tensor,  classlist: list):
-    return [classlist[l] for l in labels]
+def _record_stream(batch, stream):
+    """ mark all tensors in a batch as used by stream,
+    so their memory isn't reused while stream still needs them """
+    for v in batch.values():
+        if isinstance(v, torch.Tensor):
+            v.record_stream(stream)
+        elif isinstance(v, dict):
+            _record_stream(v, stream)
+
+
+def prefetch2cuda(loader):
+    """
+    iterates through a dataloader, moving each batch to DEVICE.
+    on cuda, the next batch is copied on a side stream while
+    the current batch is being processed.
+    """
+    if DEVICE != 'cuda':
+        for batch in loader:
+            yield batch2cuda(batch)
+        return
+
+    copy_stream = torch.cuda.Stream()
+
+    def load(batch):
+        with torch.cuda.stream(copy_stream):
+            return batch2cuda(batch)
+
+    it = iter(loader)
+    try:
+        next_batch = load(next(it))
+    except StopIteration:
+        return
+
+    while next_batch is not None:
+        # wait for the copy of the batch we're about to use
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        batch = next_batch
+        _record_stream(batch, torch.cuda.current_stream())
+
+        # start copying the next batch before handing off this one
+        try:
+            next_batch = load(next(it))
+        except StopIteration:
+            next_batch = None
+
+        yield batch
+
+
+def idx2label(labels: np.ndarray,  classlist: list):
+    return np.asarray(classlist)[labels].tolist()
+
+
+def confusion_matrix_from_idx(target: np.ndarray, pred: np.ndarray, num_classes: int):
+    """
+    computes a (num_classes, num_classes) confusion matrix from integer
+    targets and predictions, with targets along the rows
+    """
+    cm = np.bincount(target * num_classes + pred, minlength=num_classes**2)
+    return cm.reshape(num_classes, num_classes)
+
+
+def f1_from_confusion_matrix(cm: np.ndarray):
+    """
+    computes micro and macro f1 scores from a confusion matrix.
+    classes with no targets and no predictions get an f1 of 0
+    """
+    tp = np.diag(cm)
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+
+    micro_denom = 2 * tp.sum() + fp.sum() + fn.sum()
+    f1_micro = 2 * tp.sum() / micro_denom if micro_denom > 0 else 0.0
+
+    denom = 2 * tp + fp + fn
+    f1_per_class = np.divide(2 * tp, denom, out=np.zeros(len(tp)),
+                             where=denom > 0)
+    return f1_micro, f1_per_class.mean()
+
+
+def confusion_weighted_mean(cm: np.ndarray, classlist: list, fn, mistakes_only=False):
+    """
+    averages fn(pred, target) over all examples in a confusion matrix,
+    calling fn once per unique (pred, target) pair instead of once per example
+    """
+    total, count = 0.0, 0
+    for t_idx, p_idx in zip(*np.nonzero(cm)):
+        if mistakes_only and t_idx == p_idx:
+            continue
+        n = cm[t_idx, p_idx]
+        total += n * fn(classlist[p_idx], classlist[t_idx])
+        count += n
+    return total / count if count > 0 else np.nan
 
 
 def episode_metrics(outputs: dict, name: str, results_dir,
@@ -173,21 +258,27 @@ def episode_metrics(outputs: dict, name: str, results_dir,
     second order statistics for the results
     """
 
-    #  gather a concatenated list of all preds and targets
-    task_tags = [t['tag'] for t in outputs[0]['tasks']]
-    tasks = {t: [] for t in task_tags}
     results = []
     for index, epi in enumerate(outputs):
         for t in epi['tasks']:
             classlist = t['classlist']
-            pred = idx2label(t['pred'], classlist)
-            target = idx2label(t['target'], classlist)
+            # keep labels as integer indices into classlist,
+            # and only map them to strings when reporting them
+            pred = t['pred'].numpy()
+            target = t['target'].numpy()
             tag = t['tag']
+
+            # all metrics below are derived from one confusion matrix,
+            # indexed in classlist order
+            cm = confusion_matrix_from_idx(target, pred,
+                                           num_classes=len(classlist))
+            f1_micro, f1_macro = f1_from_confusion_matrix(cm)
+
             # f1 micro
             results.append({
                 'episode_idx': index,
                 'metric': 'f1_micro',
-                'value': f1_score(target, pred, average='micro', labels=classlist),
+                'value': f1_micro,
                 'tag': tag,
             })
 
@@ -195,7 +286,7 @@ def episode_metrics(outputs: dict, name: str, results_dir,
             results.append({
                 'episode_idx': index,
                 'metric': 'f1_macro',
-                'value': f1_score(target, pred, average='macro', labels=classlist),
+                'value': f1_macro,
                 'tag': tag,
             })
 
@@ -203,7 +294,7 @@ def episode_metrics(outputs: dict, name: str, results_dir,
             results.append({
                 'episode_idx': index,
                 'metric': 'epi-accuracy',
-                'value': accuracy_score(target, pred, normalize=True),
+                'value': np.trace(cm) / cm.sum(),
                 'tag': tag,
             })
 
@@ -219,7 +310,7 @@ def episode_metrics(outputs: dict, name: str, results_dir,
             results.append({
                 'episode_idx': index,
                 'metric': 'preds',
-                'value': pred,
+                'value': idx2label(pred, classlist),
                 'tag': tag,
             })
 
@@ -227,13 +318,14 @@ def episode_metrics(outputs: dict, name: str, results_dir,
             results.append({
                 'episode_idx': index,
                 'metric': 'target',
-                'value': target,
+                'value': idx2label(target, classlist),
                 'tag': tag,
             })
 
             # creating the confusion matrix for this episode
-            conf_matrix = confusion_matrix(
-                target, pred, normalize='true')
+            support = cm.sum(axis=1, keepdims=True)
+            conf_matrix = np.divide(cm, support, out=np.zeros(cm.shape),
+                                    where=support > 0)
             fig = plot_confusion_matrix(
                 conf_matrix, classlist, title=f'Episode {index} task: {tag}')
 
@@ -249,16 +341,16 @@ def episode_metrics(outputs: dict, name: str, results_dir,
                 results.append({
                     'episode_idx': index,
                     'metric': 'hlca-mistake',
-                    'value': np.mean([tree.hlca(p, tgt) for p, tgt in zip(pred, target)
-                                      if p != tgt]),
+                    'value': confusion_weighted_mean(cm, classlist, tree.hlca,
+                                                     mistakes_only=True),
                     'tag': tag,
                 })
 
                 # making variables for hierachical precision and recall
-                hP = np.mean([tree.hierarchical_precision(p, tgt)
-                              for p, tgt in zip(pred, target)])
-                hR = np.mean([tree.hierarchical_recall(p, tgt)
-                              for p, tgt in zip(pred, target)])
+                hP = confusion_weighted_mean(
+                    cm, classlist, tree.hierarchical_precision)
+                hR = confusion_weighted_mean(
+                    cm, classlist, tree.hierarchical_recall)
 
                 # tracking the hierarchical precision
                 results.append({
@@ -31,6 +31,26 @@ def chunks(l, n):
     return [l[i:i+n] for i in range(0, len(l), n)]
 
 
+def euclidean_dist(x: torch.Tensor, y: torch.Tensor):
+    """
+    pairwise euclidean distances between the rows of
+    x (shape (n, d)) and y (shape (m, d)), computed from
+    ||x||^2 + ||y||^2 - 2 x.y with a single addmm.
+    always computed in float32, even under mixed precision training,
+    since the squared norms easily overflow float16.
+    output is shape (n, m)
+    """
+    with torch.cuda.amp.autocast(enabled=False):
+        x, y = x.float(), y.float()
+        x_sq = (x * x).sum(dim=-1)
+        y_sq = (y * y).sum(dim=-1)
+        dists = torch.addmm(x_sq.unsqueeze(-1) + y_sq.unsqueeze(0),
+                            x, y.t(), alpha=-2)
+    # clamp small negative values caused by floating point error
+    # (and keep the sqrt gradient finite at 0)
+    return dists.clamp_min(1e-12).sqrt()
+
+
 class HierarchicalProtoNet(nn.Module):
     """
     A regular protonet with a  hierarchical prototypical loss.
@@ -138,15 +158,10 @@ class HierarchicalProtoNet(nn.Module):
         x_s = x_s.view(n_c * n_k, -1)
 
         # compute euclidean distances between query and prototypes
-        # this needs a batch dim, so need to unsqueeze
-        # output should be shape (b, q, c)
+        # output should be shape (q, c)
         # so that the row vectors are the logits for the classes
-        # for each query, in the batch
-        dists = torch.cdist(x_q.unsqueeze(0), x_p.unsqueeze(0), p=2)
-
-        # remove batch dim for dists
-        assert dists.shape[0] == 1
-        dists = dists[0]
+        # for each query
+        dists = euclidean_dist(x_q, x_p)
 
         metatask = {
             'classlist': episode['classlist'],
@@ -198,42 +213,20 @@ class HierarchicalProtoNet(nn.Module):
         classlist = metatask['classlist']
         prototypes = metatask['prototype_embedding']
 
-        # ordered dictionary of prototypes
-        # we will use this to group prototypes by ancestor later
-        protos = OrderedDict([(n, t)
-                              for n, t in zip(classlist, prototypes)])
-
         # get the unique list of ancestors,
         # as well as dict w format class: ancestor
         ancestor_classlist, c2a = self.get_ancestor_classlist(
             classlist, height)
 
-        # store ancestor prototypes here
-        ancestor_protos = OrderedDict()
-        for classname in classlist:
-            # get this class's ancestor
-            ancestor = c2a[classname]
+        # build a (n_ancestors, n_classes) matrix that averages
+        # the prototypes belonging to each ancestor, so that all
+        # ancestor prototypes (the prototype of the prototypes!)
+        # are computed with a single matmul
+        membership = torch.tensor([[float(c2a[c] == a) for c in classlist]
+                                   for a in ancestor_classlist])
+        membership = membership / membership.sum(dim=1, keepdim=True)
 
-            # if we have already registered this ancestor,
-            # it means we already grabbed the relevant tensors for it,
-            # so skip it
-            if ancestor in ancestor_protos:
-                continue
-
-            # otherwise, grab all the tensors that share this ancestor
-            tensor_stack = torch.stack(
-                [p for n, p in protos.items() if c2a[n] == ancestor])
-
-            # take the prototype of the prototypes!
-            ancestor_proto = tensor_stack.mean(dim=0, keepdim=False)
-
-            # register this prototype with the rest of ancestor protos
-            ancestor_protos[ancestor] = ancestor_proto
-
-        # convert the OrderedDict into a tensor for our loss function
-        # I should probably rearrange ancestor_protos here to match ancestor_classlist
-        ancestor_protos = [ancestor_protos[a] for a in ancestor_classlist]
-        ancestor_protos = torch.stack(ancestor_protos)
+        ancestor_protos = torch.mm(membership.type_as(prototypes), prototypes)
 
         return ancestor_protos
 
@@ -286,12 +279,7 @@ class HierarchicalProtoNet(nn.Module):
             query = metatask['query_embedding']
 
             # compute query-prototype distances
-            # when using cdist, make sure to unsqueeze a batch dimension
-            ancestor_dists = torch.cdist(
-                query.unsqueeze(0), ancestor_protos.unsqueeze(0), p=2)
-
-            # remember to remove batch dim from output distances
-            ancestor_dists = ancestor_dists.squeeze(0)
+            ancestor_dists = euclidean_dist(query, ancestor_protos)
 
             loss = F.cross_entropy(-ancestor_dists, ancestor_targets.view(-1))
             ancestor_task = {
@@ -7,6 +7,9 @@ import itertools
 
 import torch
 import pytorch_lightning as pl
+from pytorch_lightning.metrics.functional import accuracy
+from pytorch_lightning.metrics.functional.f_beta import f1
+from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -192,7 +195,6 @@ class MetaTask(pl.LightningModule):
         #     self.visualize_embedding_space(output, stage)
 
     def log_loss_weights(self, output):
-        import matplotlib.pyplot as plt
         if not len(output['loss-weights']) > 0:
             return
         # vec = torch.nn.functional.softmax(output['loss-weights'], dim=0).cpu()
@@ -210,9 +212,6 @@ class MetaTask(pl.LightningModule):
 
     def log_classification_task(self, task: dict, stage: str):
         """ log task metrics as scalar"""
-        from pytorch_lightning.metrics.functional import accuracy, precision_recall
-        from pytorch_lightning.metrics.functional.f_beta import f1
-
         # NOTE: assume a fixed num_classes across episodes
         num_classes = len(task['classlist'])
         self.log(f'accuracy/{task["tag"]}/{stage}',
@@ -225,7 +224,6 @@ class MetaTask(pl.LightningModule):
                  int(task['include_in_loss']))
 
     def log_confusion_matrix(self, task: dict, stage: str):
-        from sklearn.metrics import confusion_matrix
         conf_matrix = confusion_matrix(
             task['target'], task['pred'], normalize='true')
         fig = plot_confusion_matrix(conf_matrix, task['classlist'])
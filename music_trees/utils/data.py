@@ -6,6 +6,7 @@ import yaml
 from pathlib import Path
 from typing import List
 import collections
+import pickle
 
 import music_trees as mt
 
@@ -144,6 +145,44 @@ def load_entry(path, format='json'):
     return entry
 
 
+"""
+pickle
+"""
+
+
+def save_pickle(obj, path):
+    """ pickle an object to disk using the highest protocol available.
+    large contiguous buffers (e.g. numpy arrays) are passed out-of-band
+    and written raw, right after the pickled header.
+    """
+    buffers = []
+    header = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL,
+                          buffer_callback=buffers.append)
+    raw_buffers = [b.raw() for b in buffers]
+    with open(path, 'wb') as f:
+        pickle.dump((header, [b.nbytes for b in raw_buffers]), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        for b in raw_buffers:
+            f.write(b)
+
+
+def load_pickle(path):
+    """ load an object saved with save_pickle """
+    with open(path, 'rb') as f:
+        obj = pickle.load(f)
+        # files written with a plain pickle.dump have no out-of-band buffers
+        if not isinstance(obj, tuple):
+            return obj
+        header, sizes = obj
+        buffers = []
+        for size in sizes:
+            buf = bytearray(size)
+            if f.readinto(buf) != size:
+                raise EOFError(f'truncated pickle buffer in {path}')
+            buffers.append(buf)
+    return pickle.loads(header, buffers=buffers)
+
+
 """
 csv
 """